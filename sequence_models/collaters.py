@@ -1,27 +1,83 @@
 from typing import List, Any, Iterable
-import random
-
 import numpy as np
 import torch
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 
 from sequence_models.utils import Tokenizer
-from sequence_models.constants import PAD, GAP, START, STOP, MASK
+from sequence_models.constants import PAD, GAP, START, MASK
 from sequence_models.constants import ALL_AAS
 from sequence_models.gnn import get_node_features, get_edge_features, get_mask, get_k_neighbors, replace_nan
 from sequence_models.trRosetta_utils import trRosettaPreprocessing
 
+try:
+    from numba import njit
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
 
-def _pad(tokenized: List[torch.Tensor], value: int) -> torch.Tensor:
+def _pad(tokenized: List[torch.Tensor], value: int, pin_memory=False) -> torch.Tensor:
     """Utility function that pads batches to the same length."""
-    batch_size = len(tokenized)
+    if not pin_memory:
+        return pad_sequence(tokenized, batch_first=True, padding_value=value)
+    # fill a page-locked buffer directly so DataLoader(pin_memory=True) doesn't need another copy
     max_len = max(len(t) for t in tokenized)
-    output = torch.zeros((batch_size, max_len), dtype=tokenized[0].dtype) + value
+    output = torch.empty((len(tokenized), max_len), dtype=tokenized[0].dtype, pin_memory=True)
+    output.fill_(value)
     for row, t in enumerate(tokenized):
         output[row, :len(t)] = t
     return output
 
 
+if _NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _seed_numba(seed):
+        # numba keeps its own RNG state, which np.random.seed outside of jitted code doesn't reach
+        np.random.seed(seed)
+
+    @njit(cache=True)
+    def _mlm_mask(tgt, mut_ids, mask_id, n_mod):
+        """Corrupt n_mod random positions of a tokenized sequence for MLM training.
+
+        Of the chosen positions, 10% are left as is, 10% are replaced with a different token from
+        mut_ids, and 80% are replaced with mask_id. Draws from numba's RNG, see _seed_numba.
+
+        Returns the corrupted tokens and a float mask that is 1 at the chosen positions.
+        """
+        ell = len(tgt)
+        src = tgt.copy()
+        mask = np.zeros(ell, dtype=np.float32)
+        positions = np.arange(ell)
+        for i in range(n_mod):
+            # partial Fisher-Yates shuffle to sample positions without replacement
+            j = np.random.randint(i, ell)
+            idx = positions[j]
+            positions[j] = positions[i]
+            positions[i] = idx
+            mask[idx] = 1.0
+            p = np.random.random()
+            if p <= 0.10:  # do nothing
+                continue
+            elif p <= 0.20:  # replace with random amino acid
+                n_other = 0
+                for m in mut_ids:
+                    if m != tgt[idx]:
+                        n_other += 1
+                if n_other == 0:
+                    continue
+                k = np.random.randint(n_other)
+                for m in mut_ids:
+                    if m != tgt[idx]:
+                        if k == 0:
+                            src[idx] = m
+                            break
+                        k -= 1
+            else:  # mask
+                src[idx] = mask_id
+        return src, mask
+
+
 class BGCCollater(object):
     """A collater for BiGCARP models."""
 
@@ -69,6 +125,9 @@ class SimpleCollater(object):
         alphabet (str)
         pad (Boolean)
         backwards (Boolean)
+        pin_memory (Boolean): allocate padded outputs in page-locked memory. Only useful with
+            num_workers=0: batches from DataLoader workers are moved into shared memory and pinned again
+            in the main process
 
     If sequences are reversed, the padding is still on the right!
 
@@ -76,24 +135,41 @@ class SimpleCollater(object):
     Output (torch.LongTensor): tokenized batch of sequences
     """
 
-    def __init__(self, alphabet: str, pad=False, backwards=False, pad_token=PAD):
+    def __init__(self, alphabet: str, pad=False, backwards=False, pad_token=PAD, pin_memory=False):
         self.pad = pad
+        self.pin_memory = pin_memory
         self.tokenizer = Tokenizer(alphabet)
         self.backwards = backwards
         self.pad_idx = self.tokenizer.alphabet.index(pad_token)
+        # byte -> token lookup table; -1 marks characters outside the alphabet
+        self._lut = np.full(256, -1, dtype=np.int64)
+        for i, a in enumerate(self.tokenizer.alphabet):
+            self._lut[ord(a)] = i
+
+    def _encode(self, s: str) -> np.ndarray:
+        try:
+            raw = s.encode('ascii')
+        except UnicodeEncodeError as e:
+            raise KeyError(s[e.start]) from None
+        ids = self._lut[np.frombuffer(raw, dtype=np.uint8)]
+        if (ids < 0).any():
+            raise KeyError(s[int(np.argmax(ids < 0))])
+        return ids
+
+    def _tokenize(self, s: str) -> torch.Tensor:
+        return torch.from_numpy(self._encode(s))
 
     def __call__(self, batch: List[Any], ) -> List[torch.Tensor]:
-        data = tuple(zip(*batch))
-        sequences = data[0]
+        sequences = [b[0] for b in batch]
         prepped = self._prep(sequences)
         return prepped
 
     def _prep(self, sequences):
         if self.backwards:
             sequences = [s[::-1] for s in sequences]
-        sequences = [torch.LongTensor(self.tokenizer.tokenize(s)) for s in sequences]
+        sequences = [self._tokenize(s) for s in sequences]
         if self.pad:
-            sequences = _pad(sequences, self.pad_idx)
+            sequences = _pad(sequences, self.pad_idx, pin_memory=self.pin_memory)
         else:
             sequences = torch.stack(sequences)
         return (sequences,)
@@ -145,6 +221,9 @@ class LMCollater(SimpleCollater):
         alphabet (str)
         pad (Boolean)
         backwards (Boolean)
+        pin_memory (Boolean): as for SimpleCollater, only useful with
+            num_workers=0: batches from DataLoader workers are moved into shared memory and pinned again
+            in the main process
 
     If sequences are reversed, the padding is still on the right!
 
@@ -155,30 +234,33 @@ class LMCollater(SimpleCollater):
         mask (torch.LongTensor): 1 where tgt is not padding
     """
 
-    def __init__(self, alphabet: str, pad=False, backwards=False):
-        super().__init__(alphabet, pad=pad)
+    def __init__(self, alphabet: str, pad=False, backwards=False, pin_memory=False):
+        super().__init__(alphabet, pad=pad, pin_memory=pin_memory)
         self.backwards = backwards
+        self._start = np.array([self.tokenizer.start_id])
+        self._stop = np.array([self.tokenizer.stop_id])
 
     def _prep(self, sequences):
-        return self._tokenize_and_mask(*self._split(sequences))
+        return self._pad_and_mask(*self._split(sequences))
 
     def _split(self, sequences):
+        # work on token arrays so that reversing and adding START/STOP never goes back through strings
+        ids = [self._encode(s) for s in sequences]
         if not self.backwards:
-            src = [START + s for s in sequences]
-            tgt = [s + STOP for s in sequences]
+            src = [np.concatenate([self._start, t]) for t in ids]
+            tgt = [np.concatenate([t, self._stop]) for t in ids]
         else:
-            src = [STOP + s[::-1] for s in sequences]
-            tgt = [s[::-1] + START for s in sequences]
+            src = [np.concatenate([self._stop, t[::-1]]) for t in ids]
+            tgt = [np.concatenate([t[::-1], self._start]) for t in ids]
         return src, tgt
 
-    def _tokenize_and_mask(self, src, tgt):
-        src = [torch.LongTensor(self.tokenizer.tokenize(s)) for s in src]
-        tgt = [torch.LongTensor(self.tokenizer.tokenize(s)) for s in tgt]
+    def _pad_and_mask(self, src, tgt):
+        src = [torch.from_numpy(s) for s in src]
+        tgt = [torch.from_numpy(t) for t in tgt]
         mask = [torch.ones_like(t) for t in tgt]
-        pad_idx = self.tokenizer.alphabet.index(PAD)
-        src = _pad(src, pad_idx)
-        tgt = _pad(tgt, pad_idx)
-        mask = _pad(mask, 0)
+        src = _pad(src, self.pad_idx, pin_memory=self.pin_memory)
+        tgt = _pad(tgt, self.pad_idx, pin_memory=self.pin_memory)
+        mask = _pad(mask, 0, pin_memory=self.pin_memory)
         return src, tgt, mask
 
 
@@ -200,18 +282,20 @@ class AncestorCollater(LMCollater):
     """
 
     def __call__(self, batch):
-        data = tuple(zip(*batch))
-        sequences, ancestors = data[:2]
+        sequences = [b[0] for b in batch]
+        ancestors = [b[1] for b in batch]
         prepped = self._prep(sequences, ancestors)
         return prepped
 
     def _prep(self, sequences, ancestors):
+        sequences = [self._encode(s) for s in sequences]
+        ancestors = [self._encode(a) for a in ancestors]
         if self.backwards:
             sequences = [s[::-1] for s in sequences]
             ancestors = [a[::-1] for a in ancestors]
-        src = [START + s + STOP + a for s, a in zip(sequences, ancestors)]
-        tgt = [s + STOP + a + STOP for s, a in zip(sequences, ancestors)]
-        return self._tokenize_and_mask(src, tgt)
+        src = [np.concatenate([self._start, s, self._stop, a]) for s, a in zip(sequences, ancestors)]
+        tgt = [np.concatenate([s, self._stop, a, self._stop]) for s, a in zip(sequences, ancestors)]
+        return self._pad_and_mask(src, tgt)
 
 
 class MLMCollater(SimpleCollater):
@@ -220,6 +304,9 @@ class MLMCollater(SimpleCollater):
     Parameters:
         alphabet (str)
         pad (Boolean)
+        pin_memory (Boolean): as for SimpleCollater, only useful with
+            num_workers=0: batches from DataLoader workers are moved into shared memory and pinned again
+            in the main process
 
     Input (list): a batch of sequences as strings
     Output:
@@ -228,41 +315,59 @@ class MLMCollater(SimpleCollater):
         mask (torch.LongTensor): 1 where loss should be calculated for tgt
     """
 
-    def __init__(self, alphabet: str, pad=False, backwards=False, pad_token=PAD, mut_alphabet=ALL_AAS):
-        super().__init__(alphabet, pad=pad, backwards=backwards, pad_token=pad_token)
+    def __init__(self, alphabet: str, pad=False, backwards=False, pad_token=PAD, mut_alphabet=ALL_AAS,
+                 pin_memory=False):
+        super().__init__(alphabet, pad=pad, backwards=backwards, pad_token=pad_token, pin_memory=pin_memory)
         self.mut_alphabet=mut_alphabet
+        mut_ids = self._lut[np.frombuffer(mut_alphabet.encode('ascii'), dtype=np.uint8)]
+        self._mut_ids = mut_ids[mut_ids >= 0]
+        self._mask_id = self.tokenizer.mask_id
+        # row i holds every token in mut_ids except mut_ids[i]; _mut_row maps a token to its row or -1
+        self._others = np.array([[b for b in self._mut_ids if b != a] for a in self._mut_ids], dtype=np.int64)
+        self._mut_row = np.full(len(self.tokenizer.alphabet), -1, dtype=np.int64)
+        self._mut_row[self._mut_ids] = np.arange(len(self._mut_ids))
+
+    def _mask(self, tgt, n_mod, rng):
+        mod_idx = rng.choice(len(tgt), n_mod, replace=False)
+        p = rng.random(n_mod)
+        src = tgt.copy()
+        # p <= 0.10: do nothing
+        rand_idx = mod_idx[(p > 0.10) & (p <= 0.20)]  # replace with random amino acid
+        rows = self._mut_row[tgt[rand_idx]]
+        mods = self._others[rows, rng.integers(self._others.shape[1], size=len(rand_idx))]
+        outside = rows < 0  # residues outside mut_alphabet can become any of it
+        mods[outside] = rng.choice(self._mut_ids, outside.sum())
+        src[rand_idx] = mods
+        src[mod_idx[p > 0.20]] = self._mask_id  # mask
+        mask = np.zeros(len(tgt), dtype=np.float32)
+        mask[mod_idx] = 1
+        return src, mask
 
     def _prep(self, sequences):
-        tgt = list(sequences[:])
+        # seeded from the global state so that np.random.seed and DataLoader worker seeding still apply
+        seed = np.random.randint(2 ** 31 - 1)
+        if _NUMBA_AVAILABLE:
+            _seed_numba(seed)
+        else:
+            rng = np.random.default_rng(seed)
         src = []
+        tgt = []
         mask = []
         for seq in sequences:
             if len(seq) == 0:
-                tgt.remove(seq)
                 continue
-            mod_idx = random.sample(list(range(len(seq))), int(len(seq) * 0.15))
-            if len(mod_idx) == 0:
-                mod_idx = [np.random.choice(len(seq))]  # make sure at least one aa is chosen
-            seq_mod = list(seq)
-            for idx in mod_idx:
-                p = np.random.uniform()
-                if p <= 0.10:  # do nothing
-                    mod = seq[idx]
-                elif 0.10 < p <= 0.20:  # replace with random amino acid
-                    mod = np.random.choice([i for i in self.mut_alphabet if i != seq[idx]])
-                else:  # mask
-                    mod = MASK
-                seq_mod[idx] = mod
-            src.append(''.join(seq_mod))
-            m = torch.zeros(len(seq_mod))
-            m[mod_idx] = 1
-            mask.append(m)
-        src = [torch.LongTensor(self.tokenizer.tokenize(s)) for s in src]
-        tgt = [torch.LongTensor(self.tokenizer.tokenize(s)) for s in tgt]
-        pad_idx = self.tokenizer.alphabet.index(PAD)
-        src = _pad(src, pad_idx)
-        tgt = _pad(tgt, pad_idx)
-        mask = _pad(mask, 0)
+            t = self._encode(seq)
+            n_mod = max(int(len(t) * 0.15), 1)  # make sure at least one aa is chosen
+            if _NUMBA_AVAILABLE:
+                s, m = _mlm_mask(t, self._mut_ids, self._mask_id, n_mod)
+            else:
+                s, m = self._mask(t, n_mod, rng)
+            src.append(torch.from_numpy(s))
+            tgt.append(torch.from_numpy(t))
+            mask.append(torch.from_numpy(m))
+        src = _pad(src, self.pad_idx, pin_memory=self.pin_memory)
+        tgt = _pad(tgt, self.pad_idx, pin_memory=self.pin_memory)
+        mask = _pad(mask, 0, pin_memory=self.pin_memory)
         return src, tgt, mask
 
 
@@ -274,6 +379,12 @@ class StructureCollater(object):
         n_connections (int)
         n_node_features (int)
         n_edge_features (int)
+        pin_memory (boolean): allocate the graph tensors in page-locked memory. Only useful with
+            num_workers=0: batches from DataLoader workers are moved into shared memory and pinned again
+            in the main process
+        reuse_buffers (boolean): write every batch into the same (grown as needed) graph tensors. Outputs
+            are only valid until the next call, so only use this with num_workers=0 when batches are not
+            kept around.
         startstop (boolean): if true, expect the sequence collater to add starts/stops, and adds an
             extra zeroed node at the left of the graph.
 
@@ -284,11 +395,27 @@ class StructureCollater(object):
     """
 
     def __init__(self, sequence_collater: SimpleCollater, n_connections=20,
-                 n_node_features=10, n_edge_features=11):
+                 n_node_features=10, n_edge_features=11, pin_memory=False, reuse_buffers=False):
         self.sequence_collater = sequence_collater
         self.n_connections = n_connections
         self.n_node_features = n_node_features
         self.n_edge_features = n_edge_features
+        self.pin_memory = pin_memory
+        self.reuse_buffers = reuse_buffers
+        self._buffers = {}
+
+    def _zeros(self, name, shape, dtype=torch.float):
+        if not self.reuse_buffers:
+            return torch.zeros(*shape, dtype=dtype, pin_memory=self.pin_memory)
+        numel = int(np.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or buf.numel() < numel:
+            # round ell up so that slightly longer batches from a sortish sampler don't reallocate
+            n, ell = shape[:2]
+            capacity = n * ((ell + 63) // 64 * 64) * int(np.prod(shape[2:]))
+            buf = torch.empty(capacity, dtype=dtype, pin_memory=self.pin_memory)
+            self._buffers[name] = buf
+        return buf[:numel].view(*shape).zero_()
 
     def __call__(self, batch: List[Any], ) -> Iterable[torch.Tensor]:
         sequences, dists, omegas, thetas, phis = tuple(zip(*batch))
@@ -296,10 +423,10 @@ class StructureCollater(object):
         ells = [len(s) for s in sequences]
         max_ell = max(ells)
         n = len(sequences)
-        nodes = torch.zeros(n, max_ell, self.n_node_features)
-        edges = torch.zeros(n, max_ell, self.n_connections, self.n_edge_features)
-        connections = torch.zeros(n, max_ell, self.n_connections, dtype=torch.long)
-        edge_mask = torch.zeros(n, max_ell, self.n_connections, 1)
+        nodes = self._zeros('nodes', (n, max_ell, self.n_node_features))
+        edges = self._zeros('edges', (n, max_ell, self.n_connections, self.n_edge_features))
+        connections = self._zeros('connections', (n, max_ell, self.n_connections), dtype=torch.long)
+        edge_mask = self._zeros('edge_mask', (n, max_ell, self.n_connections, 1))
         for i, (ell, dist, omega, theta, phi) in enumerate(zip(ells, dists, omegas, thetas, phis)):
             # process features
             V = get_node_features(omega, theta, phi)
@@ -530,7 +657,7 @@ class Seq2PropertyCollater(SimpleCollater):
         sequences = data[0]
         prepped = self._prep(sequences)[0]
         if self.mask:
-            mask = prepped != self.tokenizer.alphabet.index(PAD)
+            mask = prepped != self.pad_idx
         if self.scatter:
             prepped = F.one_hot(prepped, len(self.tokenizer.alphabet))
 
@@ -1,9 +1,9 @@
 from typing import Union
 from pathlib import Path
 import lmdb
-import subprocess
 import string
 import json
+import mmap
 import os
 from os import path
 import pickle as pkl
@@ -221,36 +221,54 @@ class CSVDataset(Dataset):
         self.outputs = outputs
         self.data = self.data[['sequence'] + self.outputs]
         self.max_len = max_len
+        # index plain arrays in __getitem__ rather than building a pandas Series per row
+        self._seqs = self.data['sequence'].to_numpy()
+        self._outs = [self.data[c].to_numpy() for c in self.outputs]
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
-        row = self.data.iloc[idx]
-        sequence = row['sequence']
+        sequence = self._seqs[idx]
         if len(sequence) > self.max_len:
             start = np.random.choice(len(sequence) - self.max_len)
             stop = start + self.max_len
             sequence = sequence[start:stop]
-        return [sequence, *row[self.outputs]]
+        return [sequence, *[o[idx] for o in self._outs]]
 
 
 class FlatDataset(Dataset):
 
-    def __init__(self, fpath, offsets, cols=[1]):
+    def __init__(self, fpath, offsets, cols=[1], chunk_size=65536):
         self.fpath = fpath
         self.offsets = offsets
         self.cols = cols
+        self.chunk_size = chunk_size
+        self._fd = None
+        self._pid = None
 
     def __len__(self):
         return len(self.offsets)
 
+    def _read_line(self, offset):
+        # reopen after a fork so that each DataLoader worker reads through its own fd
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.fpath, os.O_RDONLY)
+            self._pid = os.getpid()
+        size = self.chunk_size
+        while True:
+            buf = os.pread(self._fd, size, offset)
+            end = buf.find(b'\n')
+            if end != -1:
+                return buf[:end]
+            if len(buf) < size:  # last line without a trailing \n
+                return buf
+            size *= 2
+
     def __getitem__(self, idx):
-        with open(self.fpath, 'r') as f:
-            f.seek(self.offsets[idx])
-            line = f.readline()[:-1]  # strip the \n
-            line = line.split(',')
-            return [line[i] for i in self.cols]
+        line = self._read_line(int(self.offsets[idx]))
+        line = line.rstrip(b'\r').split(b',')
+        return [line[i].decode('utf-8') for i in self.cols]
 
 
 class FFDataset(Dataset):
@@ -258,32 +276,56 @@ class FFDataset(Dataset):
     def __init__(self, stem, max_len=np.inf, tr_only=True):
         self.index = stem + 'ffindex'
         self.data = stem + 'ffdata'
-        result = subprocess.run(['wc', '-l', self.index], stdout=subprocess.PIPE)
-        self.length = int(result.stdout.decode('utf-8').split(' ')[0])
+        # each ffindex line is name\toffset\tlength, where length counts the trailing \0
+        with open(self.index) as f:
+            entries = [line.split('\t') for line in f if len(line.strip()) > 0]
+        # shared-memory tensors are handed to DataLoader workers by handle instead of being copied
+        self.offsets = torch.tensor([int(e[1]) for e in entries], dtype=torch.long).share_memory_()
+        self.lengths = torch.tensor([int(e[2]) for e in entries], dtype=torch.long).share_memory_()
+        self.length = len(self.offsets)
+        self._mm = None
+        self._pid = None
         self.tokenizer = Tokenizer(trR_ALPHABET)
-        self.table = str.maketrans(dict.fromkeys(string.ascii_lowercase))
+        # one bytes.translate pass drops lowercase (insertions) and, if tr_only, maps
+        # everything outside trR_ALPHABET to a gap
+        self._delete = string.ascii_lowercase.encode('ascii')
+        if tr_only:
+            tr_bytes = set(trR_ALPHABET.encode('ascii'))
+            self._btable = bytes(i if i in tr_bytes else ord('-') for i in range(256))
+        else:
+            self._btable = None
         self.max_len = max_len
         self.tr_only = tr_only
 
     def __len__(self):
         return self.length
 
+    def __getstate__(self):
+        # mmap objects cannot be pickled; workers reopen the map on first access
+        state = self.__dict__.copy()
+        state['_mm'] = None
+        state['_pid'] = None
+        return state
+
     def __getitem__(self, idx):
-        result = subprocess.run(['ffindex_get', self.data, self.index, '-n', str(idx + 1)],
-                                stdout=subprocess.PIPE)
-        a3m = result.stdout.decode('utf-8')
+        # open once per process, so a map created before the DataLoader forks is not shared by workers
+        if self._mm is None or self._pid != os.getpid():
+            with open(self.data, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._pid = os.getpid()
+        start = self.offsets[idx].item()
+        end = start + self.lengths[idx].item() - 1
+        a3m = self._mm[start:end]
         seqs = []
-        for line in a3m.split('\n'):
+        for line in a3m.split(b'\n'):
             # skip labels
             if len(line) == 0:
                 continue
-            if line[0] == '#':
+            if line[:1] == b'#':
                 continue
-            if line[0] != '>':
+            if line[:1] != b'>':
                 # remove lowercase letters and right whitespaces
-                s = line.rstrip().translate(self.table)
-                if self.tr_only:
-                    s = ''.join([a if a in trR_ALPHABET else '-' for a in s])
+                s = line.rstrip().translate(self._btable, self._delete).decode('utf-8')
                 if len(s) > self.max_len:
                     return torch.tensor([])
                 seqs.append(s)
@@ -328,9 +370,13 @@ class UniRefDataset(Dataset):
         self.structure = structure
         self.coords = coords
         with open(data_dir + 'splits.json', 'r') as f:
-            self.indices = json.load(f)[self.split]
+            # an int64 array rather than a list of ints, so forked workers don't copy its pages
+            # by touching refcounts
+            self.indices = np.array(json.load(f)[self.split], dtype=np.int64)
         metadata = np.load(self.data_dir + 'lengths_and_offsets.npz')
         self.offsets = metadata['seq_offsets']
+        self._fasta_path = self.data_dir + 'consensus.fasta'
+        self._mm = None  # opened lazily so that each DataLoader worker gets its own map
         self.pdb = pdb
         self.bins = bins
         if self.pdb or self.bins:
@@ -346,12 +392,25 @@ class UniRefDataset(Dataset):
     def __len__(self):
         return len(self.indices)
 
+    def __getstate__(self):
+        # mmap objects cannot be pickled; workers reopen the map on first access
+        state = self.__dict__.copy()
+        state['_mm'] = None
+        return state
+
+    def _read_consensus(self, offset):
+        if self._mm is None:
+            with open(self._fasta_path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        end = self._mm.find(b'\n', offset)
+        if end == -1:
+            end = len(self._mm)
+        return self._mm[offset:end].decode('ascii')
+
     def __getitem__(self, idx):
-        idx = self.indices[idx]
-        offset = self.offsets[idx]
-        with open(self.data_dir + 'consensus.fasta') as f:
-            f.seek(offset)
-            consensus = f.readline()[:-1]
+        idx = int(self.indices[idx])
+        offset = int(self.offsets[idx])
+        consensus = self._read_consensus(offset)
         if len(consensus) - self.max_len > 0:
             start = np.random.choice(len(consensus) - self.max_len)
             stop = start + self.max_len
@@ -361,10 +420,10 @@ class UniRefDataset(Dataset):
         if self.coords:
             coords = self.structures[str(idx)]
             dist, omega, theta, phi = process_coords(coords)
-            dist = torch.tensor(dist).float()
-            omega = torch.tensor(omega).float()
-            theta = torch.tensor(theta).float()
-            phi = torch.tensor(phi).float()
+            dist = torch.as_tensor(dist, dtype=torch.float32)
+            omega = torch.as_tensor(omega, dtype=torch.float32)
+            theta = torch.as_tensor(theta, dtype=torch.float32)
+            phi = torch.as_tensor(phi, dtype=torch.float32)
         elif self.structure:
             sname = 'structures/{num:{fill}{width}}.npz'.format(num=idx, fill='0', width=self.n_digits)
             fname = self.data_dir + sname
@@ -376,10 +435,15 @@ class UniRefDataset(Dataset):
                 if np.random.random() < self.p_drop:
                     structure = None
                 elif self.pdb:
-                    dist = torch.tensor(structure['dist']).float()
-                    omega = torch.tensor(structure['omega']).float()
-                    theta = torch.tensor(structure['theta']).float()
-                    phi = torch.tensor(structure['phi']).float()
+                    # copy all four maps into one contiguous float32 buffer and hand out views
+                    # every npz key access decompresses it again, so read each one exactly once
+                    d = structure['dist']
+                    ell = len(d)
+                    stacked = np.empty((4, ell, ell), dtype=np.float32)
+                    stacked[0] = d
+                    for i, k in enumerate(['omega', 'theta', 'phi'], 1):
+                        stacked[i] = structure[k]
+                    dist, omega, theta, phi = torch.from_numpy(stacked)
                     if self.bins:
                         dist, omega, theta, phi = trr_bin(dist, omega, theta, phi)
                 else:
@@ -456,10 +520,10 @@ class TRRDataset(Dataset):
         else:
             idx = np.where(dist == 0)
             dist[idx] = 20.0
-            dist = torch.tensor(dist).float()
-            omega = torch.tensor(omega).float()
-            theta = torch.tensor(theta).float()
-            phi = torch.tensor(phi).float()
+            dist = torch.as_tensor(dist, dtype=torch.float32)
+            omega = torch.as_tensor(omega, dtype=torch.float32)
+            theta = torch.as_tensor(theta, dtype=torch.float32)
+            phi = torch.as_tensor(phi, dtype=torch.float32)
         dist = dist[start:stop, start:stop]
         omega = omega[start:stop, start:stop]
         theta = theta[start:stop, start:stop]
@@ -4,35 +4,142 @@ import math
 import numpy as np
 from torch.utils.data import Sampler, BatchSampler
 
+try:
+    from numba import njit
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+
+def _batch_ends(lengths, max_tokens, max_batch, max_square_tokens, msa_depth):
+    """Greedily split lengths (in sampler order) into batches for ApproxBatchSampler.
+
+    Returns the end offset of each batch; batch i covers [ends[i - 1], ends[i]). msa_depth < 0 means no MSA.
+    """
+    # each item closes at most two batches (an empty one, then itself if max_batch == 1)
+    ends = np.empty(2 * len(lengths) + 1, dtype=np.int64)
+    n_batches = 0
+    size = 0
+    length = 0
+    ell_sq = 0
+    for i in range(len(lengths)):
+        this_length = lengths[i]
+        max_len = max(length, this_length)
+        if msa_depth < 0:
+            linear = (size + 1) * max_len
+        else:
+            linear = (size + 1) * (max_len * msa_depth ** 2 + max_len ** 2 * msa_depth)
+        quadratic = (size + 1) * max(ell_sq, this_length ** 2)
+        if linear <= max_tokens and quadratic < max_square_tokens:
+            size += 1
+            length = max_len
+            ell_sq = max(ell_sq, this_length ** 2)
+            if size == max_batch:
+                ends[n_batches] = i + 1
+                n_batches += 1
+                size = 0
+                length = 0
+        else:
+            ends[n_batches] = i
+            n_batches += 1
+            size = 1
+            length = this_length
+            ell_sq = this_length ** 2
+            if size == max_batch:
+                ends[n_batches] = i + 1
+                n_batches += 1
+                size = 0
+                length = 0
+    if size > 0:
+        ends[n_batches] = len(lengths)
+        n_batches += 1
+    return ends[:n_batches]
+
+
+if _NUMBA_AVAILABLE:
+    _batch_ends = njit(cache=True)(_batch_ends)
+
+
+def _batch_ends_vectorized(lengths, max_tokens, max_batch, max_square_tokens, msa_depth):
+    """Same batches as _batch_ends, but each batch end is found with a cumulative max and np.searchsorted.
+
+    Token counts only grow as items are added, so the items that fit in a batch are always a prefix of
+    the upcoming lengths. The window searched starts small and doubles until the cut falls inside it,
+    so the cost follows the actual batch size rather than max_batch.
+    """
+    ends = []
+    n = len(lengths)
+    # a max_batch that the batch size can never equal (e.g. np.inf) never cuts a batch
+    if not np.isfinite(max_batch) or max_batch != int(max_batch) or max_batch > n:
+        max_batch = n
+    max_batch = int(max_batch)
+    i = 0
+    forced = False  # a batch that starts with an overflowing item always keeps that item
+    ell_sq = 0  # as in _batch_ends, this is not reset when a batch is cut at max_batch
+    while i < n:
+        w = min(64, max_batch)
+        while True:
+            window = lengths[i:i + w]
+            counts = np.arange(1, len(window) + 1)
+            max_len = np.maximum.accumulate(window)
+            if msa_depth < 0:
+                linear = counts * max_len
+            else:
+                linear = counts * (max_len * msa_depth ** 2 + max_len ** 2 * msa_depth)
+            quadratic = counts * np.maximum.accumulate(np.maximum(window ** 2, ell_sq))
+            k = int(min(np.searchsorted(linear, max_tokens, side='right'),
+                        np.searchsorted(quadratic, max_square_tokens, side='left')))
+            if k < len(window) or w == max_batch or i + w >= n:
+                break
+            w = min(2 * w, max_batch)
+        if forced:
+            k = max(k, 1)
+        if k == 0:
+            ends.append(i)
+            forced = True
+            ell_sq = 0
+        elif k == max_batch:
+            i += k
+            ends.append(i)
+            forced = False
+            ell_sq = quadratic[k - 1] // k
+        else:
+            i += k
+            ends.append(i)
+            forced = True
+            ell_sq = 0
+    return np.array(ends, dtype=np.int64)
+
 
 class SortishSampler(Sampler):
     """Returns indices such that inputs with similar lengths are close together."""
 
     def __init__(self, sequence_lengths: Iterable, bucket_size: int, num_replicas: int = 1, rank: int = 0):
-        self.data = np.argsort(sequence_lengths)
+        self.flat = np.argsort(sequence_lengths).astype(np.int64)
         self.num_replicas = num_replicas
-        self.num_samples = int(math.ceil(len(self.data) * 1.0 / self.num_replicas))
+        self.num_samples = int(math.ceil(len(self.flat) * 1.0 / self.num_replicas))
         self.bucket_size = bucket_size
-        n_buckets = int(np.ceil(len(self.data) / self.bucket_size))
-        self.data = [self.data[i * bucket_size: i * bucket_size + bucket_size] for i in range(n_buckets)]
+        self.bucket_starts = np.arange(0, len(self.flat), bucket_size)
+        # buckets are views into self.flat, so shuffling a bucket shuffles self.flat in place
+        self.data = [self.flat[s: s + bucket_size] for s in self.bucket_starts]
         self.rank = rank
         self.epoch = 0
         self.total_size = self.num_samples * self.num_replicas
 
     def __iter__(self):
-        np.random.seed(self.epoch)
+        rng = np.random.Generator(np.random.PCG64(self.epoch))
         for bucket in self.data:
-            np.random.shuffle(bucket)
-        np.random.shuffle(self.data)
-        indices = [item for sublist in self.data for item in sublist]
-        indices += indices[:(self.total_size - len(indices))]
+            rng.shuffle(bucket)
+        order = rng.permutation(len(self.data))
+        indices = np.concatenate([self.flat[:0]] + [self.data[i] for i in order])
+        indices = np.concatenate([indices, indices[:(self.total_size - len(indices))]])
         assert len(indices) == self.total_size
         # subsample
         start = self.rank * self.num_samples
         end = start + self.num_samples
         indices = indices[start:end]
         assert len(indices) == self.num_samples
-        return iter(indices)
+        return iter(indices.tolist())
 
     def __len__(self):
         return self.num_samples
@@ -68,29 +175,12 @@ class ApproxBatchSampler(BatchSampler):
         self.msa_depth = msa_depth
 
     def __iter__(self):
-        batch = []
-        length = 0
-        ell_sq = 0
-        for idx in self.sampler:
-            this_length = self.sample_lengths[idx]
-            if self.msa_depth is None:
-                linear = (len(batch) + 1) * max(length, this_length)
-            else:
-                max_len = max(length, this_length)
-                linear = (len(batch) + 1) * (max_len * self.msa_depth ** 2 + max_len ** 2 * self.msa_depth)
-            quadratic = (len(batch) + 1) * max(ell_sq, this_length ** 2)
-            if linear <= self.max_tokens and quadratic < self.max_square_tokens:
-                batch.append(idx)
-                length = max(length, this_length)
-                ell_sq = max(ell_sq, this_length ** 2)
-                if len(batch) == self.max_batch:
-                    yield batch
-                    batch = []
-                    length = 0
-            else:
-                yield batch
-                batch = [idx]
-                length = this_length
-                ell_sq = this_length ** 2
-        if len(batch) > 0:
-            yield batch
+        idx_arr = np.fromiter(self.sampler, dtype=np.int64)
+        len_arr = np.asarray(self.sample_lengths, dtype=np.int64)[idx_arr]
+        msa_depth = -1 if self.msa_depth is None else self.msa_depth
+        get_ends = _batch_ends if _NUMBA_AVAILABLE else _batch_ends_vectorized
+        ends = get_ends(len_arr, float(self.max_tokens), self.max_batch, float(self.max_square_tokens), msa_depth)
+        start = 0
+        for end in ends:
+            yield idx_arr[start:end].tolist()
+            start = end
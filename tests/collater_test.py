@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import torch
+
+from sequence_models import collaters
+from sequence_models.collaters import MLMCollater
+from sequence_models.constants import PROTEIN_ALPHABET, CAN_AAS
+
+
+numba_options = [False, True] if collaters._NUMBA_AVAILABLE else [False]
+
+
+def random_batch(rng, n=16, max_len=80, alphabet=CAN_AAS):
+    return [(''.join(rng.choice(list(alphabet), rng.integers(1, max_len))),) for _ in range(n)]
+
+
+@pytest.mark.parametrize('use_numba', numba_options)
+def test_mlm_collater(monkeypatch, use_numba):
+    monkeypatch.setattr(collaters, '_NUMBA_AVAILABLE', use_numba)
+    rng = np.random.default_rng(0)
+    mut_alphabet = 'ACDEFGHIK'
+    collater = MLMCollater(PROTEIN_ALPHABET, pad=True, mut_alphabet=mut_alphabet)
+    mut_ids = {PROTEIN_ALPHABET.index(a) for a in mut_alphabet}
+    n_chosen = n_kept = n_replaced = n_masked = 0
+    for _ in range(100):
+        batch = random_batch(rng)
+        src, tgt, mask = collater(batch)
+        assert src.dtype == tgt.dtype == torch.long
+        assert src.shape == tgt.shape == mask.shape
+        expected = torch.tensor([max(int(len(s) * 0.15), 1) for s, in batch])
+        assert torch.equal(mask.sum(dim=1).long(), expected)
+        chosen = mask.bool()
+        assert torch.equal(src[~chosen], tgt[~chosen])
+        masked = src == collater.tokenizer.mask_id
+        replaced = chosen & ~masked & (src != tgt)
+        assert not (masked & ~chosen).any()
+        assert set(src[replaced].tolist()) <= mut_ids
+        n_chosen += chosen.sum().item()
+        n_kept += (chosen & (src == tgt)).sum().item()
+        n_replaced += replaced.sum().item()
+        n_masked += masked.sum().item()
+    # residues in mut_alphabet are never replaced by themselves, so keep/replace/mask split 10/10/80
+    assert abs(n_kept / n_chosen - 0.1) < 0.02
+    assert abs(n_replaced / n_chosen - 0.1) < 0.02
+    assert abs(n_masked / n_chosen - 0.8) < 0.02
+
+
+@pytest.mark.parametrize('use_numba', numba_options)
+def test_mlm_collater_seed(monkeypatch, use_numba):
+    monkeypatch.setattr(collaters, '_NUMBA_AVAILABLE', use_numba)
+    batch = random_batch(np.random.default_rng(1)) + [('',)]
+    collater = MLMCollater(PROTEIN_ALPHABET, pad=True)
+    np.random.seed(0)
+    first = collater(batch)
+    np.random.seed(0)
+    second = collater(batch)
+    assert all(torch.equal(a, b) for a, b in zip(first, second))
+    assert len(first[0]) == len(batch) - 1  # empty sequences are dropped
+
+
+def test_unknown_characters():
+    collater = collaters.SimpleCollater(PROTEIN_ALPHABET, pad=True)
+    for bad in ['AC!D', 'ACÉD']:
+        with pytest.raises(KeyError):
+            collater([(bad,)])
@@ -0,0 +1,70 @@
+import numpy as np
+
+from sequence_models import samplers
+
+
+def reference_batch_ends(lengths, max_tokens, max_batch, max_square_tokens, msa_depth):
+    # the ApproxBatchSampler loop, with a batch started by an overflowing item also closed at max_batch
+    ends = []
+    size = 0
+    length = 0
+    ell_sq = 0
+    for i, this_length in enumerate(lengths):
+        max_len = max(length, this_length)
+        if msa_depth < 0:
+            linear = (size + 1) * max_len
+        else:
+            linear = (size + 1) * (max_len * msa_depth ** 2 + max_len ** 2 * msa_depth)
+        quadratic = (size + 1) * max(ell_sq, this_length ** 2)
+        if linear <= max_tokens and quadratic < max_square_tokens:
+            size += 1
+            length = max_len
+            ell_sq = max(ell_sq, this_length ** 2)
+            if size == max_batch:
+                ends.append(i + 1)
+                size = 0
+                length = 0
+        else:
+            ends.append(i)
+            size = 1
+            length = this_length
+            ell_sq = this_length ** 2
+            if size == max_batch:
+                ends.append(i + 1)
+                size = 0
+                length = 0
+    if size > 0:
+        ends.append(len(lengths))
+    return ends
+
+
+def test_batch_ends():
+    rng = np.random.default_rng(0)
+    for trial in range(400):
+        n = int(rng.integers(1, 300))
+        lengths = rng.integers(1, 300, n).astype(np.int64)
+        max_tokens = float(rng.integers(50, 3000))
+        max_batch = [1, int(rng.integers(2, 40)), 1000, np.inf][trial % 4]
+        max_square_tokens = [np.inf, float(rng.integers(1000, 500000))][(trial // 4) % 2]
+        msa_depth = [-1, int(rng.integers(1, 5))][(trial // 8) % 2]
+        args = (lengths, max_tokens, max_batch, max_square_tokens, msa_depth)
+        expected = reference_batch_ends(lengths.tolist(), *args[1:])
+        assert samplers._batch_ends(*args).tolist() == expected
+        assert samplers._batch_ends_vectorized(*args).tolist() == expected
+
+
+def test_approx_batch_sampler():
+    rng = np.random.default_rng(1)
+    lengths = rng.integers(1, 200, 500)
+    sampler = samplers.SortishSampler(lengths, 20)
+    batches = list(iter(samplers.ApproxBatchSampler(sampler, 1000, 12, lengths)))
+    assert sorted(i for b in batches for i in b) == sorted(sampler)
+    for b in batches:
+        assert 0 < len(b) <= 12
+        assert len(b) * max(lengths[b]) <= 1000 or len(b) == 1
+
+
+def test_sortish_sampler_empty():
+    sampler = samplers.SortishSampler([], 10)
+    assert len(sampler) == 0
+    assert list(sampler) == []